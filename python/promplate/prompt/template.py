@@ -1,17 +1,30 @@
-from ast import Expr, parse, unparse
+from ast import Constant, Expr, parse, unparse
 from collections import ChainMap
-from functools import cached_property, partial
+from functools import lru_cache, partial
 from pathlib import Path
 from sys import path as sys_path
 from sys import version_info
 from textwrap import dedent
-from typing import TYPE_CHECKING, Any, Literal, Protocol
+from types import CodeType
+from typing import TYPE_CHECKING, Any, Iterable, Literal, Mapping, Protocol
 
 from .builder import *
 from .utils import *
+from .utils import (
+    _BoundedCache,
+    _cached_property,
+    _get_aclient,
+    _get_aiofiles_open,
+    _get_client,
+)
 
 Context = dict[str, Any]  # globals must be a real dict
 
+Instruction = tuple[str, ...]  # ("line", code) | ("literal", text) | ("indent",) | ("dedent",) | ("component", name, params)
+
+INDENT: Instruction = ("indent",)
+DEDENT: Instruction = ("dedent",)
+
 
 class Component(Protocol):
     def render(self, context: Context) -> str: ...
@@ -19,6 +32,31 @@ class Component(Protocol):
     async def arender(self, context: Context) -> str: ...
 
 
+@lru_cache(maxsize=4096)
+def _unwrap_token(token: str):
+    inner = token.strip()[2:-2].strip("-")
+    return dedent(inner).strip() if "\n" in inner else inner.strip()  # `dedent` is a no-op for a single line
+
+
+@lru_cache(maxsize=4096)
+def _make_context(text: str):
+    """generate context parameter if specified otherwise use locals() by default"""
+    if version_info >= (3, 13):
+        return f"globals() | locals() | dict({text[text.index(' ') + 1:]})" if " " in text else "globals() | locals()"
+    return f"locals() | dict({text[text.index(' ') + 1:]})" if " " in text else "locals()"
+
+
+def _as_constant(expression: str) -> Constant | None:
+    """return the node if the expression is a literal like `{{ "\\n" }}`, so that it can be folded at compile time"""
+    if expression.isidentifier():
+        return None
+    try:
+        node = parse(expression, mode="eval").body
+    except SyntaxError:
+        return None  # leave it to the generated script to report
+    return node if isinstance(node, Constant) else None
+
+
 class TemplateCore(AutoNaming):
     """A simple template compiler, for a jinja2-like syntax."""
 
@@ -27,95 +65,109 @@ class TemplateCore(AutoNaming):
 
         self.text = text
 
-    def _flush(self):
-        for line in self._buffer:
-            self._builder.add_line(line)
-        self._buffer.clear()
+    def _add_line(self, line: str):
+        self._instructions.append(("line", line))
 
-    @staticmethod
-    def _unwrap_token(token: str):
-        return dedent(token.strip()[2:-2].strip("-")).strip()
+    def _flush_literals(self):
+        if self._literals:
+            self._instructions.append(("literal", "".join(self._literals)))
+            self._literals.clear()
 
     def _on_literal_token(self, token: str):
-        self._buffer.append(f"__append__({repr(token)})")
+        self._literals.append(token)
 
     def _on_eval_token(self, token):
-        token = self._unwrap_token(token)
+        token = _unwrap_token(token)
+        if not token:
+            self._flush_literals()
+            return self._add_line("__append__()")  # a TypeError only when reached, so an untaken branch still renders
         if "\n" in token:
             mod = parse(token)
             [*rest, last] = mod.body
             assert isinstance(last, Expr), "{{ }} block must end with an expression, or you should use {# #} block"
-            self._buffer.extend(unparse(rest).splitlines())  # type: ignore
+            self._flush_literals()
+            for line in unparse(rest).splitlines():  # type: ignore
+                self._add_line(line)
             exp = unparse(last)
+        elif (constant := _as_constant(token)) is not None:
+            return self._literals.append(str(constant.value))
         else:
             exp = token
-        self._buffer.append(f"__append__({exp})")
+        self._flush_literals()
+        self._add_line(f"__append__(str({exp}))")
 
     def _on_exec_token(self, token):
-        self._buffer.extend(self._unwrap_token(token).splitlines())
+        lines = _unwrap_token(token).splitlines()
+        if all(not line or line.startswith("#") for line in map(str.strip, lines)):
+            return  # comments only, so the literals around it can still be merged
+        self._flush_literals()
+        for line in lines:
+            self._add_line(line)
 
-    def _on_special_token(self, token, sync: bool):
-        inner = self._unwrap_token(token)
+    def _on_special_token(self, token):
+        self._flush_literals()
+        inner = _unwrap_token(token)
 
         if inner.startswith("end"):
             last = self._ops_stack.pop()
-            assert last == inner.removeprefix("end")
-            self._flush()
-            self._builder.dedent()
+            if last != inner[3:]:  # not an `assert`, so that it still works under `python -O`
+                raise AssertionError(f"expected end{last}, got {inner}")
+            self._instructions.append(DEDENT)
 
         else:
             op = inner.split(" ", 1)[0]
+            getattr(self, self._special_handlers.get(op, "_on_component"))(op, inner)
 
-            if op == "if" or op == "for" or op == "while":
-                self._ops_stack.append(op)
-                self._flush()
-                self._builder.add_line(f"{inner}:")
-                self._builder.indent()
+    def _on_block(self, op: str, inner: str):
+        self._ops_stack.append(op)
+        self._add_line(f"{inner}:")
+        self._instructions.append(INDENT)
 
-            elif op == "else" or op == "elif":
-                self._flush()
-                self._builder.dedent()
-                self._builder.add_line(f"{inner}:")
-                self._builder.indent()
+    def _on_branch(self, op: str, inner: str):
+        self._instructions.append(DEDENT)
+        self._add_line(f"{inner}:")
+        self._instructions.append(INDENT)
 
-            else:
-                params: str = self._make_context(inner)
-                if sync:
-                    self._buffer.append(f"__append__({op}.render({params}))")
-                else:
-                    self._buffer.append(f"__append__(await {op}.arender({params}))")
+    def _on_component(self, op: str, inner: str):
+        self._instructions.append(("component", op, _make_context(inner)))
 
-    @staticmethod
-    def _make_context(text: str):
-        """generate context parameter if specified otherwise use locals() by default"""
-        if version_info >= (3, 13):
-            return f"globals() | locals() | dict({text[text.index(' ') + 1:]})" if " " in text else "globals() | locals()"
-        return f"locals() | dict({text[text.index(' ') + 1:]})" if " " in text else "locals()"
+    _special_handlers = {"if": "_on_block", "for": "_on_block", "while": "_on_block", "else": "_on_branch", "elif": "_on_branch"}
 
-    def compile(self, sync=True, indent_str="\t"):
-        self._buffer = []
+    def _parse(self) -> list[Instruction]:
+        """tokenize the template and check its blocks, which doesn't depend on whether it is rendered synchronously"""
+        self._instructions: list[Instruction] = []
+        self._literals = []
         self._ops_stack = []
-        self._builder = get_base_builder(sync, indent_str)
-
-        for token in split_template_tokens(self.text):
-            if not token:
-                continue
-            s_token = token.strip()
-            if s_token.startswith("{{") and s_token.endswith("}}"):
-                self._on_eval_token(token)
-            elif s_token.startswith("{#") and s_token.endswith("#}"):
-                self._on_exec_token(token)
-            elif s_token.startswith("{%") and s_token.endswith("%}") and "\n" not in s_token:
-                self._on_special_token(token, sync)
-            else:
-                self._on_literal_token(token)
+
+        handlers = {
+            LITERAL: self._on_literal_token,
+            SPECIAL: self._on_special_token,
+            EVAL: self._on_eval_token,
+            EXEC: self._on_exec_token,
+        }
+
+        for kind, token in split_template_tokens(self.text):
+            handlers[kind](token)
 
         if self._ops_stack:
             raise SyntaxError(self._ops_stack)
 
-        self._flush()
-        self._builder.add_line("return ''.join(map(str, __parts__))")
-        self._builder.dedent()
+        self._flush_literals()
+
+        instructions = self._instructions
+        del self._instructions, self._literals, self._ops_stack
+        return instructions
+
+    @_cached_property
+    def _parse_result(self) -> tuple[Instruction, ...]:
+        if not _shares_compilation(type(self)):
+            return tuple(self._parse())  # the hooks may depend on the instance, so nothing is shared
+        if (instructions := _parsed.get(self.text)) is None:
+            instructions = _parsed[self.text] = tuple(self._parse())
+        return instructions
+
+    def compile(self, sync=True, indent_str="\t"):
+        return _lower(self._parse_result, sync, indent_str)
 
     error_handling: Literal["linecache", "tempfile", "file"] = "file" if __debug__ else "tempfile"
 
@@ -127,24 +179,61 @@ class TemplateCore(AutoNaming):
                 file = save_tempfile(self.name, self.get_script(sync, "\t"), self.error_handling == "tempfile")
                 sys_path.append(str(file.parent))
 
-    @cached_property
+    @_cached_property
+    def _static_result(self) -> str | None:
+        """the output of a template without any dynamic part, which can be returned without running any code"""
+        if type(self).compile is not TemplateCore.compile:
+            return None  # a custom `compile` may generate something else from the same instructions
+        match self._parse_result:
+            case ():
+                return ""
+            case (("literal", result),):
+                return result
+        return None
+
+    @_cached_property
+    def _own_codes(self) -> dict[bool, CodeType]:
+        return {}  # for classes whose compilation may depend on the instance
+
+    def _compile_code(self, sync: bool) -> CodeType:
+        if _shares_compilation(type(self)):
+            cache, key = _compiled, (self.text, sync)
+            code = _precompiled.get(key) or cache.get(key)
+        else:
+            cache, key = self._own_codes, sync
+            code = cache.get(key)
+        if code is None:
+            code = cache[key] = self.compile(sync).get_render_function().__code__
+        return code
+
+    def precompile(self):
+        """compile both render functions now, e.g. at import time, and keep them for the whole process"""
+        for sync in (True, False):
+            code = self._compile_code(sync)
+            if _shares_compilation(type(self)):
+                _precompiled[(self.text, sync)] = code
+        return self
+
+    @_cached_property
     def _render_code(self):
-        self.compile()
-        return self._builder.get_render_function().__code__.replace(co_filename=self.name, co_name="render")
+        return self._compile_code(True).replace(co_filename=self.name, co_name="render")
 
     def render(self, context: Context) -> str:
+        if self._static_result is not None:
+            return self._static_result
         try:
             return eval(self._render_code, context)
         except Exception:
             self._patch_for_error_handling(sync=True)
             raise
 
-    @cached_property
+    @_cached_property
     def _arender_code(self):
-        self.compile(sync=False)
-        return self._builder.get_render_function().__code__.replace(co_filename=self.name, co_name="arender")
+        return self._compile_code(False).replace(co_filename=self.name, co_name="arender")
 
     async def arender(self, context: Context) -> str:
+        if self._static_result is not None:
+            return self._static_result
         try:
             return await eval(self._arender_code, context)
         except Exception:
@@ -153,8 +242,59 @@ class TemplateCore(AutoNaming):
 
     def get_script(self, sync=True, indent_str="    "):
         """compile template string into python script"""
-        self.compile(sync, indent_str)
-        return str(self._builder)
+        return str(self.compile(sync, indent_str))
+
+
+_compile_hooks = (
+    "compile",
+    "_parse",
+    "_add_line",
+    "_flush_literals",
+    "_on_literal_token",
+    "_on_eval_token",
+    "_on_exec_token",
+    "_on_special_token",
+    "_on_block",
+    "_on_branch",
+    "_on_component",
+    "_special_handlers",
+)
+
+
+@lru_cache
+def _shares_compilation(cls: type[TemplateCore]) -> bool:
+    """whether templates of this class compile the same text to the same code as `TemplateCore` does"""
+    return all(getattr(cls, name) is getattr(TemplateCore, name) for name in _compile_hooks)
+
+
+_parsed: _BoundedCache[str, tuple[Instruction, ...]] = _BoundedCache(1024)  # filled by the templates rendering them
+
+
+def _lower(instructions: Iterable[Instruction], sync=True, indent_str="\t"):
+    """generate the render function from the parsed instructions, only components differ between sync and async"""
+    builder = get_base_builder(sync, indent_str)
+
+    for instruction in instructions:
+        match instruction:
+            case ("line", line):
+                builder.add_line(line)
+            case ("literal", text):
+                builder.add_line(f"__append__({text!r})")
+            case ("indent",):
+                builder.indent()
+            case ("dedent",):
+                builder.dedent()
+            case ("component", op, params):
+                if sync:
+                    builder.add_line(f"__append__(str({op}.render({params})))")
+                else:
+                    builder.add_line(f"__append__(str(await {op}.arender({params})))")
+
+    return builder.add_line("return ''.join(__parts__)").dedent()
+
+
+_compiled: _BoundedCache[tuple[str, bool], CodeType] = _BoundedCache(1024)  # shared by all templates with the same text
+_precompiled: dict[tuple[str, bool], CodeType] = {}  # never evicted, unlike the cache above
 
 
 class Loader(AutoNaming):
@@ -167,9 +307,7 @@ class Loader(AutoNaming):
 
     @classmethod
     async def aread(cls, path: str | Path, encoding="utf-8"):
-        from aiofiles import open
-
-        async with open(path, encoding=encoding) as f:
+        async with _get_aiofiles_open()(path, encoding=encoding) as f:
             content = await f.read()
 
         path = Path(path)
@@ -190,22 +328,25 @@ class Loader(AutoNaming):
 
         return urljoin("https://promplate.dev/", url)
 
+    @staticmethod
+    def _url_stem(url: str):
+        """same as `Path(url).stem` for a url, without going through the path parser"""
+        name = url.rstrip("/").rsplit("/", 1)[-1]
+        i = name.rfind(".")
+        return name[:i] if 0 < i < len(name) - 1 else name
+
     @classmethod
     def fetch(cls, url: str, **kwargs):
-        from .utils import _get_client
-
         response = _get_client().get(cls._join_url(url), **cls._patch_kwargs(kwargs))
         obj = cls(response.raise_for_status().text)
-        obj.name = Path(url).stem
+        obj.name = cls._url_stem(url)
         return obj
 
     @classmethod
     async def afetch(cls, url: str, **kwargs):
-        from .utils import _get_aclient
-
         response = await _get_aclient().get(cls._join_url(url), **cls._patch_kwargs(kwargs))
         obj = cls(response.raise_for_status().text)
-        obj.name = Path(url).stem
+        obj.name = cls._url_stem(url)
         return obj
 
 
@@ -221,23 +362,54 @@ class SafeChainMapContext(ChainMap, dict):
         copy: Callable[[Self], Self]
 
 
+def _merge_into(target: dict, mapping: Mapping) -> bool:
+    """flatten plain dicts and chains of them into `target`, return False if any layer may compute its values lazily"""
+
+    if type(mapping) is dict:
+        target.update(mapping)
+        return True
+
+    if (
+        isinstance(mapping, ChainMap)
+        and type(mapping).__getitem__ is ChainMap.__getitem__
+        and type(mapping).__missing__ is ChainMap.__missing__
+    ):
+        return all(_merge_into(target, layer) for layer in reversed(mapping.maps))
+
+    return False
+
+
 class Template(TemplateCore, Loader):
     def __init__(self, text: str, /, context: Context | None = None):
         super().__init__(text)
         self.context = {} if context is None else context
 
-    def render(self, context: Context | None = None):
-        if context is None:
-            context = SafeChainMapContext({}, self.context)
-        else:
-            context = SafeChainMapContext({}, context, self.context)
+    def _make_globals(self, context: Context | None) -> Context:
+        """
+        Merge the layers into a fresh plain dict when possible.
+        A dict subclass as globals defeats the fast `LOAD_GLOBAL` path, so the chain map is only kept for lazy mappings.
+        """
 
-        return super().render(context)
+        if type(self.context) is dict:
+            if context is None:
+                return self.context.copy()
+            if type(context) is dict:
+                return self.context | context
 
-    async def arender(self, context: Context | None = None):
-        if context is None:
-            context = SafeChainMapContext({}, self.context)
-        else:
-            context = SafeChainMapContext({}, context, self.context)
+        layers = (self.context,) if context is None else (context, self.context)
+
+        merged = {}
+        for layer in reversed(layers):
+            if not _merge_into(merged, layer):
+                return SafeChainMapContext({}, *layers)
+        return merged
 
-        return await super().arender(context)
+    def render(self, context: Context | None = None):
+        if self._static_result is not None:
+            return self._static_result  # skip merging the context too
+        return super().render(self._make_globals(context))
+
+    async def arender(self, context: Context | None = None):
+        if self._static_result is not None:
+            return self._static_result
+        return await super().arender(self._make_globals(context))
@@ -2,11 +2,52 @@ from functools import cache, cached_property, wraps
 from inspect import currentframe, isclass
 from pathlib import Path
 from re import compile
-from typing import Any, Callable, ParamSpec, TypeVar
-
-split_template_tokens = compile(
-    r"((?:\s{%-|{%).*?(?:%}|-%}\s))|((?:\s{{-|{{)[\s\S]*?(?:}}|-}}\s))|((?:\s{#-|{#)[\s\S]*?(?:#}|-#}\s))"
-).split
+from typing import Any, Callable, Generic, ParamSpec, TypeVar
+
+LITERAL, SPECIAL, EVAL, EXEC = range(4)
+
+_kinds = {"%": SPECIAL, "{": EVAL, "#": EXEC}
+_closings = {"%": "%}", "{": "}}", "#": "#}"}
+
+
+def split_template_tokens(text: str):
+    """
+    Yield `(kind, token)` pairs, skipping empty literals.
+
+    Tags are located with `str.find` instead of a regex. A `{% %}` tag can't span lines,
+    and a `-` just inside a tag also takes one whitespace character outside of it.
+    """
+
+    find = text.find
+    n = len(text)
+    last = 0  # where the pending literal starts
+    i = find("{")
+
+    while i != -1 and i + 1 < n:
+        mark = text[i + 1]
+        if mark in _kinds:
+            start, body = i, i + 2
+            if text[i + 2 : i + 3] == "-" and i > last and text[i - 1].isspace():
+                start, body = i - 1, i + 3  # `-` also swallows one whitespace before the tag
+            if mark == "%":  # {% %} must be single-line, so don't look past the end of the line
+                line_end = find("\n", body)
+                close = find("%}", body, n if line_end == -1 else line_end)
+            else:
+                close = find(_closings[mark], body)
+            if close != -1:
+                end = close + 2
+                if close > body and text[close - 1] == "-" and end < n and text[end].isspace():
+                    end += 1  # and one whitespace after it
+                if start > last:
+                    yield LITERAL, text[last:start]
+                yield _kinds[mark], text[start:end]
+                last = end
+                i = find("{", end)
+                continue
+        i = find("{", i + 1)
+
+    if last < n:
+        yield LITERAL, text[last:]
 
 
 var_name_checker = compile(r"[_a-zA-Z]\w*$")
@@ -86,6 +127,40 @@ def cache_once(func: Callable[P, T]) -> Callable[P, T]:
     return wrapper
 
 
+class _cached_property(Generic[T]):
+    """a lock-free `functools.cached_property`, the value is stored in the instance's `__dict__` on first access"""
+
+    def __init__(self, func: Callable[[Any], T]):
+        self.func = func
+        self.name = func.__name__
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, instance, owner=None) -> T:
+        if instance is None:
+            return self  # type: ignore
+        value = instance.__dict__[self.name] = self.func(instance)
+        return value
+
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+
+class _BoundedCache(dict[K, V]):
+    """a dict which forgets its oldest entry once it holds more than `maxsize` items"""
+
+    def __init__(self, maxsize: int):
+        super().__init__()
+        self.maxsize = maxsize
+
+    def __setitem__(self, key: K, value: V):
+        super().__setitem__(key, value)
+        if len(self) > self.maxsize:
+            del self[next(iter(self))]
+
+
 @cache_once
 def get_builtins() -> dict[str, Any]:
     return __builtins__ if isinstance(__builtins__, dict) else __builtins__.__dict__
@@ -125,18 +200,32 @@ def _is_http2_available():
         return False
 
 
+@cache_once
+def _get_aiofiles_open():
+    from aiofiles import open
+
+    return open
+
+
+def _get_limits():
+    from httpx import Limits
+
+    # httpx's default cap on connections, but more idle ones kept alive since the clients are shared by every loader
+    return Limits(max_connections=100, max_keepalive_connections=64)
+
+
 @cache_once
 def _get_client():
     from httpx import Client
 
-    return Client(follow_redirects=True, http2=_is_http2_available())
+    return Client(follow_redirects=True, http2=_is_http2_available(), limits=_get_limits())
 
 
 @cache_once
 def _get_aclient():
     from httpx import AsyncClient
 
-    return AsyncClient(follow_redirects=True, http2=_is_http2_available())
+    return AsyncClient(follow_redirects=True, http2=_is_http2_available(), limits=_get_limits())
 
 
 def add_linecache(filename: str, source_getter: Callable[[], str]):
@@ -6,7 +6,14 @@ from traceback import format_exc
 from pytest import raises
 
 from promplate import Node, Template
-from promplate.prompt.utils import get_builtins
+from promplate.prompt.utils import (
+    EVAL,
+    EXEC,
+    LITERAL,
+    SPECIAL,
+    get_builtins,
+    split_template_tokens,
+)
 
 
 def render_assert(text: str, context: dict | None = None, expected: str | None = None):
@@ -413,13 +420,13 @@ def test_error_handling():
         t.error_handling = False  # type: ignore
         t.render()
     except NameError:
-        assert "__append__(a)" not in format_exc()
+        assert "__append__(str(a))" not in format_exc()
 
     try:
         t.error_handling = "linecache"
         t.render()
     except NameError:
-        assert "__append__(a)" in format_exc()
+        assert "__append__(str(a))" in format_exc()
 
 
 def test_error_handling_namesake():
@@ -429,3 +436,190 @@ def test_error_handling_namesake():
         Template("{# raise TypeError(123) #}").render()
     except TypeError:
         assert "ValueError" not in format_exc()
+
+
+def test_compiled_code_shared_between_instances():
+    from promplate.prompt.template import _compiled
+
+    _compiled.clear()
+    first = Template("{{ a }}")
+    second = Template("{{ a }}")
+    first._render_code
+    code = _compiled[("{{ a }}", True)]
+    second._render_code
+    assert len(_compiled) == 1 and _compiled[("{{ a }}", True)] is code
+    assert first._render_code.co_filename == "first"
+    assert second._render_code.co_filename == "second"
+    assert first.render({"a": 1}) == second.render({"a": 1}) == "1"
+
+
+def test_context_layers_precedence():
+    template = Template("{{ a }}{{ b }}{# c = 3 #}", {"a": 1, "b": 1})
+    assert template.render({"b": 2}) == "12"
+    assert template.render() == "11"
+    assert template.context == {"a": 1, "b": 1}
+
+
+def test_chain_context_layers():
+    from promplate import ChainContext
+
+    assert Template("{{ a }}{{ b }}").render(ChainContext({"a": 1}, {"a": 2, "b": 3})) == "13"
+    assert Template("{{ a }}{{ b }}").render(ChainContext({"a": 1}, get_builtins(), defaultdict(int))) == "10"
+
+
+def test_split_template_tokens():
+    assert list(split_template_tokens("a{{ b }}{# c #}{% d %}\n{{- e -}}\n{#")) == [
+        (LITERAL, "a"),
+        (EVAL, "{{ b }}"),
+        (EXEC, "{# c #}"),
+        (SPECIAL, "{% d %}"),
+        (EVAL, "\n{{- e -}}\n"),
+        (LITERAL, "{#"),
+    ]
+
+
+def test_merge_literals_around_comments():
+    assert "__append__('Hello, world!')" in Template("Hello, {## comment ##}world{#\n# another one\n#}!").get_script()
+    render_assert("a{# b = 1 #}{{ b }}{# c = 2 #}{{ c }}", None, "a12")
+
+
+def test_fold_constant_expressions():
+    assert "__append__('a\\n1b')" in Template('a{{ "\\n" }}{{ 1 }}b').get_script()
+    render_assert('{{ "\\n" }}{{ n }}{{ None }}', {"n": 1}, "\n1None")
+
+
+def test_stringify_when_appended():
+    render_assert("{{ nums }}{# nums.append(3) #}{{ nums }}", {"nums": [1, 2]}, "[1, 2][1, 2, 3]")
+
+
+def test_url_stem():
+    from pathlib import Path
+
+    for url in ("main.j2", "a/b.tar.gz", "https://promplate.dev/x/y.txt", "dir/", ".hidden", "trailing.", "no_suffix"):
+        assert Template._url_stem(url) == Path(url).stem
+
+
+def test_sync_and_async_scripts():
+    template = Template("{% for i in x %}{% a %}{% endfor %}")
+    sync, async_ = template.get_script(), template.get_script(sync=False)
+    assert "a.render(" in sync and "async def" not in sync
+    assert "await a.arender(" in async_ and async_.startswith("async def")
+
+
+def test_split_template_tokens_edge_cases():
+    assert list(split_template_tokens("a {%- b -%} c")) == [(LITERAL, "a"), (SPECIAL, " {%- b -%} "), (LITERAL, "c")]
+    assert list(split_template_tokens("{% a\n %}{{ {} }}}")) == [(LITERAL, "{% a\n %}"), (EVAL, "{{ {} }}"), (LITERAL, "}")]
+    assert list(split_template_tokens("{{- a -}}-{{")) == [(EVAL, "{{- a -}}"), (LITERAL, "-{{")]
+
+
+def test_split_template_tokens_stray_tags():
+    text = "50{% off\n" * 10000 + "%}"
+    assert list(split_template_tokens(text)) == [(LITERAL, text)]
+
+
+async def test_static_template():
+    template = Template("You are a helpful assistant.{## no code ##}{{ '\\n' }}")
+    assert template._static_result == "You are a helpful assistant.\n"
+    assert template.render() == await template.arender() == "You are a helpful assistant.\n"
+    assert Template("{{ a }}")._static_result is None
+
+
+async def test_precompile():
+    from promplate.prompt.template import _compiled
+
+    template = Template("{{ a }}{% b %}").precompile()
+    _compiled.clear()
+    assert template.render({"a": 1, "b": Template("2")}) == "12"
+    assert await Template("{{ a }}{% b %}").arender({"a": 1, "b": Template("2")}) == "12"
+    assert not _compiled
+    assert template.name == "template"
+
+
+def test_subclass_hooks_used_for_rendering():
+    class Upper(Template):
+        def _on_literal_token(self, token: str):
+            super()._on_literal_token(token.upper())
+
+    template = Upper("hi {{ a }}")
+    assert template.render({"a": "there"}) == "HI there"
+    assert "'HI '" in template.get_script()
+    assert Template("hi {{ a }}").render({"a": "there"}) == "hi there"
+
+
+def test_instance_state_used_for_parsing():
+    class Prefixed(Template):
+        prefix = ""
+
+        def _on_literal_token(self, token: str):
+            super()._on_literal_token(self.prefix + token)
+
+    a, b = Prefixed("hi"), Prefixed("hi")
+    a.prefix, b.prefix = "> ", "# "
+    assert (a.render(), b.render()) == ("> hi", "# hi")
+    assert Template("hi").render() == "hi"
+
+    a, b = Prefixed("hi {{ x }}"), Prefixed("hi {{ x }}")
+    a.prefix, b.prefix = "> ", "# "
+    assert (a.render({"x": 1}), b.render({"x": 1})) == ("> hi 1", "# hi 1")
+
+
+def test_subclass_with_extra_init_args():
+    class Tagged(Template):
+        def __init__(self, text: str, tag: str):
+            super().__init__(text)
+            self.tag = tag
+
+    assert Tagged("static", "t").render() == "static"
+    assert Tagged("{{ a }}", "t").render({"a": 1}) == "1"
+    assert Tagged("{{ a }}", "t").precompile().render({"a": 2}) == "2"
+
+
+def test_subclass_compile_used_for_rendering():
+    class Shout(Template):
+        def compile(self, sync=True, indent_str="\t"):
+            builder = super().compile(sync, indent_str)
+            builder.code[-2] = "return ''.join(__parts__) + '!'"  # the last line
+            return builder
+
+    assert Shout("static").render() == "static!"
+    assert Shout("{{ a }}").render({"a": 1}) == "1!"
+
+
+def test_empty_eval_block():
+    with raises(TypeError):
+        render_assert("Hi {{ }}!")
+    with raises(TypeError):
+        render_assert("Hi {{- -}}!")
+    render_assert("Hi {% if x %}{{ }}{% endif %}!", {"x": 0}, "Hi !")
+
+
+async def test_non_str_component():
+    class Answer:
+        def render(self, context):
+            return 42
+
+        async def arender(self, context):
+            return 42
+
+    assert Template("a{% c %}b").render({"c": Answer()}) == "a42b"
+    assert await Template("a{% c %}b").arender({"c": Answer()}) == "a42b"
+
+
+def test_subclass_special_handlers():
+    class NoComponents(Template):
+        def _on_component(self, op: str, inner: str):
+            self._literals.append(f"<{op}>")
+
+    assert NoComponents("{% if 1 %}{% a b=1 %}{% endif %}").render() == "<a>"
+
+
+def test_shared_client_limits():
+    from pytest import importorskip
+
+    importorskip("httpx")
+
+    from promplate.prompt.utils import _get_limits
+
+    limits = _get_limits()
+    assert limits.max_connections == 100
+    assert limits.max_keepalive_connections == 64